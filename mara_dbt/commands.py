@@ -1,9 +1,12 @@
+import datetime
 import json
 import shlex
 from warnings import warn
 from typing import Optional, List, Tuple, Union
 
+import mara_pipelines.config
 from mara_page import _
+from mara_pipelines.logging import logger
 from mara_pipelines.pipelines import Command
 
 from . import config
@@ -48,7 +51,8 @@ class _DbtCommand(Command):
 class _DbtSelectCommand(_DbtCommand):
     """ A base class for a dbt cli command which supports selecting nodes """
     def __init__(self, command: str, select: Optional[Union[List[str], str]] = None, exclude: Optional[Union[List[str], str]] = None,
-                 selector: Optional[str] = None, full_refresh: Optional[bool] = None, target: Optional[str] = None, variables: Optional[dict] = None):
+                 selector: Optional[str] = None, full_refresh: Optional[bool] = None, target: Optional[str] = None, variables: Optional[dict] = None,
+                 profile_slowest_nodes: Optional[int] = None):
         """
         Executes a dbt command
 
@@ -61,12 +65,34 @@ class _DbtSelectCommand(_DbtCommand):
             target: the dbt target. If not set config.dbt_target() is used.
             variables: Supply variables to the project. This argument
                        overrides variables defined in config.dbt_variables()
+            profile_slowest_nodes: If set, captures after the run the execution plans of the given
+                                   number of slowest models. Only exposed by commands running models.
         """
+        if profile_slowest_nodes is not None and (not isinstance(profile_slowest_nodes, int)
+                                                  or isinstance(profile_slowest_nodes, bool)
+                                                  or profile_slowest_nodes <= 0):
+            raise ValueError(f'profile_slowest_nodes must be a positive integer, got {profile_slowest_nodes!r}')
         super().__init__(command, target, variables)
         self.select = select
         self.exclude = exclude
         self.selector = selector
         self.full_refresh = full_refresh
+        self.profile_slowest_nodes = profile_slowest_nodes
+
+    def run(self) -> bool:
+        started_at = datetime.datetime.utcnow()
+        if not super().run():
+            return False
+        if self.profile_slowest_nodes:
+            from . import profiling
+            try:
+                profiling.profile_slowest_nodes(db_alias=self.target or mara_pipelines.config.default_db_alias(),
+                                                top_n=self.profile_slowest_nodes, started_at=started_at,
+                                                select=self.select, exclude=self.exclude, selector=self.selector)
+            except Exception as e:
+                # profiling is diagnostic only and must not fail a successful dbt run
+                logger.log(f'Profiling failed: {e}', is_error=True)
+        return True
 
     def shell_command(self):
         command = super().shell_command()
@@ -84,6 +110,7 @@ class _DbtSelectCommand(_DbtCommand):
             ('exclude nodes', _.tt[self.exclude] if self.exclude else None),
             ('selector', _.tt[self.selector] if self.selector else None),
             ('full refresh', _.tt[self.full_refresh] if self.full_refresh is not None else None),
+            ('profile slowest nodes', _.tt[self.profile_slowest_nodes] if self.profile_slowest_nodes else None),
         ]
 
 
@@ -160,7 +187,8 @@ class DbtSeed(_DbtSelectCommand):
 class DbtBuild(_DbtSelectCommand):
     def __init__(self, select: Optional[Union[List[str], str]] = None, exclude: Optional[Union[List[str], str]] = None,
         selector: Optional[str] = None, full_refresh: bool = False,
-        target: Optional[str] = None, variables: Optional[dict] = None):
+        target: Optional[str] = None, variables: Optional[dict] = None,
+        profile_slowest_nodes: Optional[int] = None):
         """
         Executes dbt build
 
@@ -174,9 +202,12 @@ class DbtBuild(_DbtSelectCommand):
             target: the dbt target. If not set config.dbt_target() is used.
             variables: Supply variables to the project. This argument
                        overrides variables defined in config.dbt_variables()
+            profile_slowest_nodes: If set, captures after the run the execution plans of the given
+                                   number of slowest models. The dbt target must be a mara db alias.
+                                   See profiling.profile_slowest_nodes()
         """
         super().__init__('build', select=select, exclude=exclude, selector=selector, full_refresh=full_refresh,
-                         target=target, variables=variables)
+                         target=target, variables=variables, profile_slowest_nodes=profile_slowest_nodes)
 
 
 class DbtSnapshot(_DbtSelectCommand):
@@ -206,7 +237,8 @@ class DbtSnapshot(_DbtSelectCommand):
 class DbtRun(_DbtSelectCommand):
     def __init__(self, select: Optional[Union[List[str], str]] = None, exclude: Optional[Union[List[str], str]] = None,
         selector: Optional[str] = None, full_refresh: bool = False,
-        target: Optional[str] = None, variables: Optional[dict] = None, **kargs):
+        target: Optional[str] = None, variables: Optional[dict] = None,
+        profile_slowest_nodes: Optional[int] = None, **kargs):
         """
         Executes dbt run
 
@@ -220,6 +252,9 @@ class DbtRun(_DbtSelectCommand):
             target: the dbt target. If not set config.dbt_target() is used.
             variables: Supply variables to the project. This argument
                        overrides variables defined in config.dbt_variables()
+            profile_slowest_nodes: If set, captures after the run the execution plans of the given
+                                   number of slowest models. The dbt target must be a mara db alias.
+                                   See profiling.profile_slowest_nodes()
         """
         if select is None and 'models' in kargs:
             warn("Use parameter 'select' instead of 'models' in command DbtRun", DeprecationWarning, stacklevel=2)
@@ -228,7 +263,7 @@ class DbtRun(_DbtSelectCommand):
             warn("Use parameter 'exclude' instead of 'exclude_models' command DbtRun", DeprecationWarning, stacklevel=2)
             exclude = kargs['exclude_models']
         super().__init__('run', select=select, exclude=exclude, selector=selector, full_refresh=full_refresh,
-                         target=target, variables=variables)
+                         target=target, variables=variables, profile_slowest_nodes=profile_slowest_nodes)
 
 
 class DbtCompile(_DbtSelectCommand):
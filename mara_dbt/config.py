@@ -80,3 +80,28 @@ def schema_name() -> Optional[str]:
 def manifest_file_path() -> str:
     """ The dbt manifest file, usually placed at 'target/manifest.json' """
     return str(pathlib.Path('.dbt/target/manifest.json').absolute())
+
+
+def run_results_file_path() -> str:
+    """ The dbt run results file, usually placed at 'target/run_results.json' """
+    return str(pathlib.Path('.dbt/target/run_results.json').absolute())
+
+
+def profiling_dir() -> str:
+    """ The folder in which the execution plans of profiled dbt nodes are saved """
+    return str(pathlib.Path('.dbt/profiling').absolute())
+
+
+def profiling_explain_analyze() -> bool:
+    """
+    If the execution plans of profiled PostgreSQL models are captured with EXPLAIN ANALYZE.
+
+    This reruns the select of the model, bounded by profiling_statement_timeout(). When
+    disabled or when the timeout is exceeded, a plain EXPLAIN without execution is used.
+    """
+    return True
+
+
+def profiling_statement_timeout() -> Optional[str]:
+    """ The PostgreSQL statement_timeout for an EXPLAIN ANALYZE rerun of a profiled model, e.g. '5min' """
+    return '5min'
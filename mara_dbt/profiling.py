@@ -0,0 +1,318 @@
+"""Captures execution plans of the slowest dbt models after a dbt run"""
+import datetime
+import json
+import pathlib
+from functools import singledispatch
+from typing import Optional, List, Union
+
+import mara_db.config
+from mara_db import dbs
+from mara_pipelines.logging import logger
+
+from . import config
+
+
+def load_run_results():
+    """Loads and returns the dbt run_results.json file content"""
+    with open(config.run_results_file_path()) as f:
+        return json.load(f)
+
+
+def _parse_timestamp(timestamp: str) -> datetime.datetime:
+    """Parses a dbt UTC timestamp like '2022-12-02T10:00:00.123456Z' into a naive datetime"""
+    seconds, _, fraction = timestamp.rstrip('Z').partition('.')
+    return (datetime.datetime.strptime(seconds, '%Y-%m-%dT%H:%M:%S')
+            + datetime.timedelta(microseconds=int(fraction[:6].ljust(6, '0')) if fraction else 0))
+
+
+def _normalize_selection(selection: Optional[Union[List[str], str]]) -> List[str]:
+    if not selection:
+        return []
+    return sorted(' '.join(selection if isinstance(selection, (list, tuple)) else [selection]).split())
+
+
+def is_run_results_of(run_results, started_at: datetime.datetime, select: Optional[Union[List[str], str]] = None,
+                      exclude: Optional[Union[List[str], str]] = None, selector: Optional[str] = None) -> bool:
+    """
+    Checks that a run results file has been written by a dbt invocation started at `started_at`
+    with the given node selection and not by a concurrently running dbt command.
+
+    Args:
+        run_results: The run results file. See load_run_results()
+        started_at: The UTC time before the dbt invocation has been started
+        select: The nodes included by the dbt invocation
+        exclude: The nodes excluded by the dbt invocation
+        selector: The selector used by the dbt invocation
+    """
+    generated_at = run_results.get('metadata', {}).get('generated_at')
+    if not generated_at or _parse_timestamp(generated_at) < started_at:
+        return False
+
+    args = run_results.get('args', {})
+    return (_normalize_selection(args.get('select')) == _normalize_selection(select)
+            and _normalize_selection(args.get('exclude')) == _normalize_selection(exclude)
+            # `selector_name` has been renamed to `selector` in dbt 1.5
+            and (args.get('selector') or args.get('selector_name')) == selector)
+
+
+PROFILED_MATERIALIZATIONS = ['table', 'incremental']
+
+
+def slowest_model_results(run_results, manifest, top_n: int) -> List[dict]:
+    """
+    Returns the results of the `top_n` slowest successful models of a dbt run.
+
+    Only models materialized as table or incremental are returned: for views (the mara
+    default) and ephemeral models dbt does not execute the select of the model.
+
+    Args:
+        run_results: The run results file. See load_run_results()
+        manifest: The manifest file. See integration.load_manifest()
+        top_n: The number of models to return
+    """
+    nodes = manifest.get('nodes', {})
+    results = [result for result in run_results['results']
+               if result['unique_id'].split('.')[0] == 'model' and result.get('status') == 'success'
+               and nodes.get(result['unique_id'], {}).get('config', {}).get('materialized') in PROFILED_MATERIALIZATIONS]
+    results.sort(key=lambda result: result.get('execution_time') or 0, reverse=True)
+    return results[:top_n]
+
+
+def compiled_sql(result: dict, manifest: Optional[dict] = None) -> Optional[str]:
+    """Returns the compiled sql of a node, either from the manifest or from the run result"""
+    node = (manifest or {}).get('nodes', {}).get(result['unique_id'], {})
+    for source in [node, result]:
+        # `compiled_sql` has been renamed to `compiled_code` in dbt 1.3
+        sql = source.get('compiled_code') or source.get('compiled_sql')
+        if sql:
+            return sql
+    return None
+
+
+@singledispatch
+def capture_plan(db: object, result: dict, sql: Optional[str]) -> Optional[dict]:
+    """
+    Captures the execution plan of a dbt node run on a mara database
+
+    Args:
+        db: The mara database on which the node has been run
+        result: The run result of the node from the run_results.json file
+        sql: The compiled sql of the node
+
+    Returns:
+        A dict with the keys `plan` (the raw plan) and `shape` (a comparable
+        structure of the plan without volatile values like timings and row counts)
+        or None when no plan could be captured.
+    """
+    return None # by default we ignore not supported dbs
+
+
+@capture_plan.register(dbs.PostgreSQLDB)
+def __(db: dbs.PostgreSQLDB, result: dict, sql: Optional[str]):
+    import psycopg2.extensions
+    from mara_db.postgresql import postgres_cursor_context
+
+    if not sql:
+        return None
+    sql = sql.strip().rstrip(';')
+
+    def shape(node: dict):
+        return [node['Node Type'], node.get('Relation Name'), node.get('Index Name'), node.get('Join Type'),
+                [shape(child) for child in node.get('Plans', [])]]
+
+    def explain(options: str, statement_timeout: Optional[str] = None):
+        with postgres_cursor_context(db) as cursor:
+            # EXPLAIN ANALYZE executes the select, which must not have side effects
+            cursor.execute('SET TRANSACTION READ ONLY')
+            if statement_timeout:
+                cursor.execute('SET LOCAL statement_timeout = %s', (statement_timeout,))
+            cursor.execute(f'EXPLAIN ({options}) {sql}')
+            plan = cursor.fetchone()[0]
+            return json.loads(plan) if isinstance(plan, str) else plan
+
+    if config.profiling_explain_analyze():
+        # reruns the select of the model, the materialization itself is not executed
+        try:
+            plan = explain('ANALYZE, BUFFERS, FORMAT JSON', statement_timeout=config.profiling_statement_timeout())
+            return {'plan': plan, 'shape': shape(plan[0]['Plan'])}
+        except psycopg2.extensions.QueryCanceledError:
+            logger.log(f'EXPLAIN ANALYZE of {result["unique_id"]} exceeded the statement timeout '
+                       f'{config.profiling_statement_timeout()}, falling back to EXPLAIN',
+                       format=logger.Format.ITALICS)
+
+    plan = explain('FORMAT JSON')
+    return {'plan': plan, 'shape': shape(plan[0]['Plan'])}
+
+
+@capture_plan.register(dbs.RedshiftDB)
+def __(db: dbs.RedshiftDB, result: dict, sql: Optional[str]):
+    from mara_db.postgresql import postgres_cursor_context
+
+    columns = ['stm', 'seg', 'step', 'maxtime', 'avgtime', 'rows', 'bytes',
+               'rate_row', 'rate_byte', 'label', 'is_diskbased', 'workmem', 'is_rrscan']
+
+    timing = {entry['name']: entry for entry in result.get('timing') or []}
+    if not timing.get('execute', {}).get('started_at'):
+        return None
+    started_at = _parse_timestamp(timing['execute']['started_at'])
+
+    # dbt adds a query comment containing the node id to each query it executes
+    node_id_pattern = (f'"node_id": "{result["unique_id"]}"'
+                       .replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+
+    with postgres_cursor_context(db) as cursor:
+        # the longest running query of the node is the one creating or inserting the data,
+        # not the rename/drop housekeeping statements issued afterwards
+        cursor.execute("""
+SELECT query
+FROM stl_query
+WHERE querytxt LIKE %s
+  AND starttime >= %s
+ORDER BY endtime - starttime DESC
+LIMIT 1""", (f'%{node_id_pattern}%', started_at))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        query_id = row[0]
+
+        cursor.execute(f"""
+SELECT {', '.join(columns)}
+FROM svl_query_summary
+WHERE query = %s
+ORDER BY stm, seg, step""", (query_id,))
+        plan = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    for step in plan:
+        step['label'] = step['label'].strip() if step['label'] else step['label']
+
+    return {'plan': {'query': query_id, 'steps': plan},
+            'shape': [[step['stm'], step['seg'], step['step'], step['label'], step['is_diskbased']]
+                      for step in plan]}
+
+
+@capture_plan.register(dbs.BigQueryDB)
+def __(db: dbs.BigQueryDB, result: dict, sql: Optional[str]):
+    from mara_db.bigquery import bigquery_client
+
+    adapter_response = result.get('adapter_response') or {}
+    if not adapter_response.get('job_id'):
+        return None
+
+    client = bigquery_client(db)
+    job = client.get_job(adapter_response['job_id'],
+                         project=adapter_response.get('project_id'),
+                         location=adapter_response.get('location') or db.location)
+    statistics = job.to_api_repr().get('statistics', {})
+
+    return {'plan': statistics,
+            'shape': [[stage.get('name'), [step.get('kind') for step in stage.get('steps', [])]]
+                      for stage in statistics.get('query', {}).get('queryPlan', [])]}
+
+
+def first_shape_difference(previous_shape: list, shape: list) -> Optional[tuple]:
+    """
+    Returns the innermost plan node (without its child nodes) in which two plan shapes
+    first differ as a tuple (previous node, current node), or None when they are equal
+    """
+    def leafs(node):
+        return [item for item in node if not isinstance(item, list)] if isinstance(node, list) else node
+
+    if previous_shape == shape:
+        return None
+    if not isinstance(previous_shape, list) or not isinstance(shape, list):
+        return (previous_shape, shape)
+    for previous_item, item in zip(previous_shape, shape):
+        if previous_item != item:
+            if isinstance(previous_item, list) and isinstance(item, list):
+                return first_shape_difference(previous_item, item)
+            return (leafs(previous_shape), leafs(shape))
+    # one shape has more items than the other
+    common_length = min(len(previous_shape), len(shape))
+    return (previous_shape[common_length:] or None, shape[common_length:] or None)
+
+
+def profile_slowest_nodes(db_alias: str, top_n: int, started_at: datetime.datetime,
+                          select: Optional[Union[List[str], str]] = None, exclude: Optional[Union[List[str], str]] = None,
+                          selector: Optional[str] = None):
+    """
+    Captures the execution plans of the `top_n` slowest table and incremental models of the last dbt run
+    and stores them together with the compiled sql in config.profiling_dir().
+
+    When the plan of a model differs from the previous capture, this is logged.
+
+    Args:
+        db_alias: The mara database alias the dbt target points to
+        top_n: The number of slowest models to profile
+        started_at: The UTC time before the dbt run has been started
+        select: The nodes included by the dbt run
+        exclude: The nodes excluded by the dbt run
+        selector: The selector used by the dbt run
+    """
+    if db_alias not in mara_db.config.databases():
+        logger.log(f'Profiling skipped: no mara database with alias "{db_alias}"', format=logger.Format.ITALICS)
+        return
+    db = dbs.db(db_alias)
+
+    from .integration import load_manifest
+    run_results = load_run_results()
+    if not is_run_results_of(run_results, started_at, select=select, exclude=exclude, selector=selector):
+        # e.g. overwritten by a dbt command running in parallel
+        logger.log('Profiling skipped: run_results.json has not been written by this dbt run',
+                   format=logger.Format.ITALICS)
+        return
+    try:
+        manifest = load_manifest()
+    except FileNotFoundError:
+        logger.log('Profiling skipped: no manifest.json to read the model materializations from',
+                   format=logger.Format.ITALICS)
+        return
+
+    profiling_dir = pathlib.Path(config.profiling_dir())
+    profiling_dir.mkdir(parents=True, exist_ok=True)
+
+    for result in slowest_model_results(run_results, manifest, top_n):
+        unique_id = result['unique_id']
+        sql = compiled_sql(result, manifest)
+        try:
+            captured_plan = capture_plan(db, result, sql)
+        except Exception as e:
+            logger.log(f'Could not capture plan of {unique_id}: {e}', is_error=True)
+            continue
+        if not captured_plan:
+            logger.log(f'No plan captured for {unique_id}', format=logger.Format.ITALICS)
+            continue
+
+        # json round trip so that the shape is comparable with the one read from file
+        shape = json.loads(json.dumps(captured_plan['shape'], default=str))
+
+        plan_file = profiling_dir / f'{unique_id}.plan.json'
+        previous_shape = None
+        if plan_file.exists():
+            try:
+                with open(plan_file) as f:
+                    previous_shape = json.load(f).get('shape')
+            except ValueError as e:
+                logger.log(f'Could not read previous plan of {unique_id}: {e}', is_error=True)
+            plan_file.replace(profiling_dir / f'{unique_id}.previous.plan.json')
+
+        if sql:
+            with open(profiling_dir / f'{unique_id}.sql', 'w') as f:
+                f.write(sql)
+
+        with open(plan_file, 'w') as f:
+            json.dump({
+                'unique_id': unique_id,
+                'db_alias': db_alias,
+                'captured_at': datetime.datetime.now().isoformat(),
+                'execution_time': result.get('execution_time'),
+                'plan': captured_plan['plan'],
+                'shape': shape
+            }, f, indent=2, default=str)
+
+        message = f'{unique_id} ({result.get("execution_time") or 0:.1f}s): plan written to {plan_file}'
+        difference = first_shape_difference(previous_shape, shape) if previous_shape is not None else None
+        if difference:
+            logger.log(f'!!! PLAN CHANGED for {unique_id} since previous capture '
+                       f'(see {profiling_dir / f"{unique_id}.previous.plan.json"})')
+            logger.log(f'- {json.dumps(difference[0])}\n+ {json.dumps(difference[1])}', format=logger.Format.VERBATIM)
+        logger.log(message, format=logger.Format.ITALICS)
@@ -0,0 +1,106 @@
+import datetime
+
+import pytest
+
+from mara_dbt.profiling import (_normalize_selection, is_run_results_of, slowest_model_results,
+                                compiled_sql, first_shape_difference)
+
+
+STARTED_AT = datetime.datetime(2022, 12, 2, 10, 0, 1, 500000)
+
+
+def _run_results(generated_at: str = '2022-12-02T10:00:05.123456Z', **args):
+    return {'metadata': {'generated_at': generated_at}, 'args': args, 'results': []}
+
+
+@pytest.mark.parametrize('selection, expected', [
+    (None, []),
+    ('', []),
+    ('my_model', ['my_model']),
+    ('b a', ['a', 'b']),
+    (['b', 'a'], ['a', 'b']),
+    (('b a',), ['a', 'b']),
+])
+def test_normalize_selection(selection, expected):
+    assert _normalize_selection(selection) == expected
+
+
+def test_is_run_results_of():
+    run_results = _run_results(select=['my_model'], exclude=[])
+    assert is_run_results_of(run_results, STARTED_AT, select=['my_model'])
+    assert is_run_results_of(run_results, STARTED_AT, select='my_model')
+    assert not is_run_results_of(run_results, STARTED_AT, select='other_model')
+    assert not is_run_results_of(run_results, STARTED_AT, select='my_model', exclude='other_model')
+
+
+def test_is_run_results_of_stale_file():
+    assert not is_run_results_of(_run_results('2022-12-02T09:59:59.000000Z', select=['my_model']),
+                                 STARTED_AT, select='my_model')
+    # generated in the same second, but before the command has been started
+    assert not is_run_results_of(_run_results('2022-12-02T10:00:01.200000Z', select=['my_model']),
+                                 STARTED_AT, select='my_model')
+    assert is_run_results_of(_run_results('2022-12-02T10:00:01.700000Z', select=['my_model']),
+                             STARTED_AT, select='my_model')
+    assert not is_run_results_of({'args': {'select': ['my_model']}}, STARTED_AT, select='my_model')
+
+
+def test_is_run_results_of_dbt_versions():
+    # dbt < 1.5
+    assert is_run_results_of(_run_results(select=('tag:daily',), selector_name=None), STARTED_AT, select='tag:daily')
+    assert is_run_results_of(_run_results(selector_name='nightly'), STARTED_AT, selector='nightly')
+    # dbt >= 1.5
+    assert is_run_results_of(_run_results(select=['tag:daily'], selector=None), STARTED_AT, select='tag:daily')
+    assert is_run_results_of(_run_results(selector='nightly'), STARTED_AT, selector='nightly')
+    assert not is_run_results_of(_run_results(selector='nightly'), STARTED_AT, selector='hourly')
+    # timestamp without fraction
+    assert is_run_results_of(_run_results('2022-12-02T10:00:02Z'), STARTED_AT)
+
+
+def test_slowest_model_results():
+    run_results = {'results': [
+        {'unique_id': 'model.mara.fast', 'status': 'success', 'execution_time': 1.0},
+        {'unique_id': 'model.mara.slow', 'status': 'success', 'execution_time': 10.0},
+        {'unique_id': 'model.mara.medium', 'status': 'success', 'execution_time': 5.0},
+        {'unique_id': 'model.mara.failed', 'status': 'error', 'execution_time': 20.0},
+        {'unique_id': 'model.mara.view', 'status': 'success', 'execution_time': 30.0},
+        {'unique_id': 'test.mara.not_null', 'status': 'pass', 'execution_time': 40.0},
+    ]}
+    manifest = {'nodes': {
+        'model.mara.fast': {'config': {'materialized': 'table'}},
+        'model.mara.slow': {'config': {'materialized': 'incremental'}},
+        'model.mara.medium': {'config': {'materialized': 'table'}},
+        'model.mara.failed': {'config': {'materialized': 'table'}},
+        'model.mara.view': {'config': {'materialized': 'view'}},
+    }}
+
+    assert [result['unique_id'] for result in slowest_model_results(run_results, manifest, 2)] \
+        == ['model.mara.slow', 'model.mara.medium']
+    assert [result['unique_id'] for result in slowest_model_results(run_results, manifest, 10)] \
+        == ['model.mara.slow', 'model.mara.medium', 'model.mara.fast']
+    assert slowest_model_results(run_results, {'nodes': {}}, 10) == []
+
+
+def test_compiled_sql():
+    result = {'unique_id': 'model.mara.a', 'compiled_code': 'select 2'}
+    assert compiled_sql(result, {'nodes': {'model.mara.a': {'compiled_code': 'select 1'}}}) == 'select 1'
+    # dbt < 1.3
+    assert compiled_sql(result, {'nodes': {'model.mara.a': {'compiled_sql': 'select 1'}}}) == 'select 1'
+    assert compiled_sql(result, None) == 'select 2'
+    assert compiled_sql({'unique_id': 'model.mara.a'}, {'nodes': {}}) is None
+
+
+def test_first_shape_difference():
+    previous_shape = ['Hash Join', None, None, 'Inner', [['Seq Scan', 'a', None, None, []],
+                                                         ['Seq Scan', 'b', None, None, []]]]
+    shape = ['Hash Join', None, None, 'Inner', [['Seq Scan', 'a', None, None, []],
+                                                ['Index Scan', 'b', 'b_pkey', None, []]]]
+    assert first_shape_difference(previous_shape, previous_shape) is None
+    assert first_shape_difference(previous_shape, shape) \
+        == (['Seq Scan', 'b', None, None], ['Index Scan', 'b', 'b_pkey', None])
+
+
+def test_first_shape_difference_additional_items():
+    assert first_shape_difference([['s1', ['READ']]], [['s1', ['READ']], ['s2', ['WRITE']]]) \
+        == (None, [['s2', ['WRITE']]])
+    assert first_shape_difference([[0, 0, 1, 'scan'], [0, 0, 2, 'hash']], [[0, 0, 1, 'scan']]) \
+        == ([[0, 0, 2, 'hash']], None)